@@ -1,342 +1,461 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Sun Oct  9 11:12:54 2022
-
-This module inspects the growth and secretion profiles of Genome-Scale Metabolic 
-Models (GSMMs) derived from a specific microbial community. The algorithm 
-implemented here gathers the Flux varibility analysis (FVA) solutions of all 
-models growth simulations in the rhizosphere environment, extracts their 
-secretion profiles, and iteratively adds the secreted compounds to the 
-environment (medium) for further growth simulations.
-
-Community growth simulations begin with medium 0 - the intial rhizosphere 
-enviornment medium.
-
-Outputs of this module are csv files generated after each iteration, 
-indicating the models growing, their secretion profiles and the media generated.
-
-@author: ginatta
-"""
-
-# =============================================================================
-# libraries, paths and constants
-# =============================================================================
-
-import cobra
-import pandas as pd
-import os
-
-base_dir = ''
-media_dir = base_dir + 'media/' # directory of all media
-models_dir = base_dir + 'models/' # directory of all models
-target_dir = base_dir + 'target/' # target dir in which output files will be saved
-
-# =============================================================================
-# functions
-# =============================================================================
-
-def read_models(path):
-    '''
-    A function for creating model objects using COBRA
-    which represent different microbial species
-
-    Parameters
-    ----------
-    path : str
-        the path of all models
-
-    Returns
-    -------
-    models : list
-        array of COBRA-model objects.
-    '''
-    models = []
-    for model_name in os.listdir(path):
-        model = cobra.io.read_sbml_model(path + '/' + model_name)
-        print(model.id)
-        models.append(model)
-    return models
-
-
-def get_exchanges(model):
-    '''
-    A function to gather all exchanges a model holds
-
-    Parameters
-    ----------
-    model : COBRA model object
-
-    Returns
-    -------
-    model_data : list
-        array of exchanges.
-
-    '''
-    sep = ' '
-    model_exchanges = []
-    data = model.exchanges
-    for datum in data:
-        datum = str(datum)
-        datum = datum.split(sep,1)[0]
-        datum = datum.replace(':', '')
-        model_exchanges.append(datum)
-    return model_exchanges
-
-
-def get_model_specific_medium(model, medium_dict):
-    '''
-    A function for specifically modifying the medium dict, to suit a specific model.
-    This function makes sure that the environment medium used by a model, would be
-    composed of exchanges found within the model.
-
-    Parameters
-    ----------
-    model : COBRA-model object
-
-    medium_dict : dict
-        A dictionary representing the medium in which the model is intended to grow
-
-    Returns
-    -------
-    specific_medium : dict
-        A suited specific medium to be used by the model
-
-    '''
-    exchanges = get_exchanges(model)
-    temp_li = []
-    for k, v in medium_dict.items():
-        if k in exchanges:
-            temp_li.append(k)
-    specific_medium = {i: 1000 for i in temp_li}
-    return specific_medium
-
-
-def get_secretion_profile(model):
-    '''
-    A function for gathering the FVA secretion profile of a model grown in a
-    specific medium.Importantly, this function assumes that the desired medium
-    which the model should be testedin, has already been assigned to the model
-    via the model.medium attribute.
-
-    Parameters
-    ----------
-    model : COBRA-model object
-
-    Returns
-    -------
-    solution : pandas DataFrame
-        A dataframe representing the secretion profile of a model
-
-    '''
-    print(model)
-    # assuming desired medium has already been assigned to model as medium
-    solution = model.summary(fva=0.9).secretion_flux # this is a df
-    solution.drop(['reaction', 'metabolite', 'flux', 'maximum'], axis=1, inplace=True)
-    solution = solution.loc[~(solution==0).all(axis=1)]
-    return solution
-
-
-def create_secretions_df(secretion_df_list ,relevant_models):
-    '''
-    A function for gathering the secretion profiles of all models
-    who grew in a specific growth iteration
-
-    Parameters
-    ----------
-    secretion_df_list : list
-        An array of secretion profiles dataframes, of models who grew in that
-        specific iteration
-    relevant_models : list
-        an array of models who grew in the environment in that specific
-        iteration
-
-    Returns
-    -------
-    secretion_df : pandas DataFrame
-        a matrix represnting the secretion profiles of all models
-        who grew in that specific iteration.
-
-    '''
-    df_dict = {}
-    for model, df_ in zip(relevant_models, secretion_df_list):
-        df_dict[model.id] = df_
-    mod_df_dict = {k: v for k, v in df_dict.items() if v.empty != True}
-    dfs = list(mod_df_dict.values())
-    names = [name for name in list(mod_df_dict.keys())]
-    secretion_df = pd.concat(dfs, axis=1)
-    secretion_df.columns = names
-    return secretion_df
-
-
-def iterate_growth_and_secretion(models, medium):
-    '''
-    An operative function using all the above functions to simulate the growth
-    of community GSMMs in a specific enviornment, as well as obtaining both
-    the secretion profile of the community, and consequently the medium for
-    the next iteration to be executed.
-
-    Parameters
-    ----------
-    models : list
-        array of all GSMM model objects.
-
-    medium : dict
-        A dict representing the medium used in that specific iteration.
-
-    Returns
-    -------
-    A tuple holding:
-
-        1. next_round_medium
-        2. growths_dict
-        3. secretions_combined_df:
-
-        next_round_medium : dict
-            a dictionary holding all compounds secreted by the bacteria grew in
-            the last round, added to the compounds already present from the last round
-
-        growths_dict : dict
-            dictionary holding models as keys and their growth as value for each round
-
-        secretions_combined_df : df
-            .df holding all secretion values for each itereations, added to the one before.
-
-    '''
-    growths_dict = {}
-    secretion_dfs = []
-    relevant_models = []
-    for model in models:
-        medium_ = get_model_specific_medium(model, medium) # assign the correct medium as input
-        model.medium = medium_
-        growth = model.slim_optimize()
-        if growth > 0:
-            relevant_models.append(model)
-            growths_dict[model.id] = growth
-            secretion_profile = get_secretion_profile(model)
-            secretion_dfs.append(secretion_profile)
-
-    secretions_combined_df = create_secretions_df(secretion_dfs, relevant_models)
-    secretions_combined = secretions_combined_df.index.tolist()
-    secretions_combined = {i : 1000 for i in secretions_combined}
-    next_round_medium = {**medium, **secretions_combined}
-    return next_round_medium, growths_dict, secretions_combined_df
-
-
-
-def medium_dict_to_df(medium, target_path, medium_name: str):
-    '''
-    A function to save the medium dict after each iteration as a dataframe.
-
-    Parameters
-    ----------
-    medium : dict
-        a dictionary of the new medium composed of secretions at current
-        iteration and the former iteration's medium.
-
-    target_path : str
-        A path for the directory in which the medium is saved
-
-    medium_name : str
-        The name of the given medium
-
-    Returns
-    -------
-    None.
-
-    '''
-    df_ = pd.DataFrame(medium.items(), columns=['exchange', 'flux'])
-    df_.to_csv(target_path + 'media/' + medium_name + '.csv')
-
-def save_secretion_and_growths_dfs(growths, secretions_df, number: str):
-    '''
-    A function to save the secretions and growths dataframes.
-
-    Parameters
-    ----------
-    growths : dict
-        A dictionary holding the growth values of all GSMMs who grew in
-        the current iteration.
-    secretions_df : pandas DataFrame
-        A dataframe representing the secretions of commnity members at
-        that specific iteration.
-    number : str
-        a string of a number representing the iteration in which the growth
-        and secretion data were gathered
-
-    Returns
-    -------
-    None.
-
-    '''
-    growth_df = pd.DataFrame(growths.items(), columns=['GSMM', 'growth'])
-    growth_df.to_csv(target_dir + 'growths/' + 'growths_' + number + '.csv')
-    secretions_df.to_csv(target_dir + 'secretions/' + 'secretion_' + number + '.csv')
-
-
-
-# =============================================================================
-# =============================================================================
-# ITERATION RUNS ARE SEPARATED SINCE RUNTIME IS LONG AND DATA ACQUISITION IS 
-# NECESSARY 
-# =============================================================================
-# =============================================================================
-
-# =============================================================================
-# preliminary runs of the iterations.
-# =============================================================================
-
-models = read_models(models_dir)
-
-medium_0 = pd.read_csv(media_dir + 'initial_root_environment_medium_for_iterations.csv', index_col=0)
-medium_0 = dict(medium_0.values)
-
-# =============================================================================
-# iteration 1
-# =============================================================================
-
-medium_1, growths_1, secretions_1 = iterate_growth_and_secretion(models, medium_0)
-
-medium_dict_to_df(medium_1, target_dir, 'medium_1')
-save_secretion_and_growths_dfs(growths_1, secretions_1, '1')
-
-# =============================================================================
-# iteration 2
-# =============================================================================
-
-
-medium_2, growths_2, secretions_2 = iterate_growth_and_secretion(models, medium_1)
-
-medium_dict_to_df(medium_2, target_dir, 'medium_2')
-save_secretion_and_growths_dfs(growths_2, secretions_2, '2')
-
-# =============================================================================
-# iteration 3
-# =============================================================================
-
-medium_3, growths_3, secretions_3 = iterate_growth_and_secretion(models, medium_2)
-
-medium_dict_to_df(medium_3, target_dir, 'medium_3')
-save_secretion_and_growths_dfs(growths_3, secretions_3, '3')
-
-# =============================================================================
-# iteration 4
-# =============================================================================
-
-P_compounds = pd.read_csv(media_dir + 'P_compounds_from_minimal_media.csv', index_col=0)
-P_compounds = dict(P_compounds.values) # an addition of more compounds to medium
-
-comb_medium = {**P_compounds, **medium_3}
-
-medium_4, growths_4, secretions_4 = iterate_growth_and_secretion(models, comb_medium)
-
-medium_dict_to_df(medium_4, target_dir, 'medium_4')
-save_secretion_and_growths_dfs(growths_4, secretions_4, '4')
-
-# =============================================================================
-# iteration 5
-# =============================================================================
-
-medium_5, growths_5, secretions_5 = iterate_growth_and_secretion(models, medium_4)
-
-medium_dict_to_df(medium_5, target_dir, 'medium_5')
-save_secretion_and_growths_dfs(growths_5, secretions_5, '5')
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct  9 11:12:54 2022
+
+This module inspects the growth and secretion profiles of Genome-Scale Metabolic 
+Models (GSMMs) derived from a specific microbial community. The algorithm 
+implemented here gathers the Flux varibility analysis (FVA) solutions of all 
+models growth simulations in the rhizosphere environment, extracts their 
+secretion profiles, and iteratively adds the secreted compounds to the 
+environment (medium) for further growth simulations.
+
+Community growth simulations begin with medium 0 - the intial rhizosphere 
+enviornment medium.
+
+Outputs of this module are csv files generated after each iteration, 
+indicating the models growing, their secretion profiles and the media generated.
+
+@author: ginatta
+"""
+
+# =============================================================================
+# libraries, paths and constants
+# =============================================================================
+
+import cobra
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import os
+from cobra.flux_analysis import flux_variability_analysis
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+base_dir = ''
+media_dir = base_dir + 'media/' # directory of all media
+models_dir = base_dir + 'models/' # directory of all models
+target_dir = base_dir + 'target/' # target dir in which output files will be saved
+
+# prefer a commercial LP solver when one is installed, otherwise keep the
+# default (glpk); set once so every model created afterwards inherits it
+for solver_name in ('cplex', 'gurobi'):
+    try:
+        cobra.Configuration().solver = solver_name
+        break
+    except Exception:
+        continue
+
+# =============================================================================
+# functions
+# =============================================================================
+
+def read_models(path):
+    '''
+    A function for creating model objects using COBRA
+    which represent different microbial species.
+    The SBML files are parsed in parallel by a pool of worker processes;
+    the returned list keeps the order of the model file names.
+
+    Parameters
+    ----------
+    path : str
+        the path of all models
+
+    Returns
+    -------
+    models : list
+        array of COBRA-model objects.
+    '''
+    model_paths = [path + '/' + model_name for model_name in sorted(os.listdir(path))]
+    models = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for model in executor.map(cobra.io.read_sbml_model, model_paths):
+            print(model.id)
+            get_exchange_ids(model) # populate the exchange cache once, at load time
+            models.append(model)
+    return models
+
+
+def get_exchange_ids(model):
+    '''
+    A function to gather the ids of all exchanges a model holds.
+    The exchanges of a model do not change between iterations, so the set is
+    computed once per model and cached on the model object itself.
+
+    Parameters
+    ----------
+    model : COBRA model object
+
+    Returns
+    -------
+    exchange_ids : frozenset
+        set of exchange reaction ids.
+
+    '''
+    try:
+        return model._exchange_ids
+    except AttributeError:
+        model._exchange_ids = frozenset(rxn.id for rxn in model.exchanges)
+        return model._exchange_ids
+
+
+def get_model_specific_medium(model, medium_dict):
+    '''
+    A function for specifically modifying the medium dict, to suit a specific model.
+    This function makes sure that the environment medium used by a model, would be
+    composed of exchanges found within the model.
+
+    Parameters
+    ----------
+    model : COBRA-model object
+
+    medium_dict : dict
+        A dictionary representing the medium in which the model is intended to grow
+
+    Returns
+    -------
+    specific_medium : dict
+        A suited specific medium to be used by the model
+
+    '''
+    exchange_ids = get_exchange_ids(model)
+    specific_medium = {k: 1000 for k in medium_dict.keys() & exchange_ids}
+    return specific_medium
+
+
+def get_secretion_profile(model):
+    '''
+    A function for gathering the FVA secretion profile of a model grown in a
+    specific medium.Importantly, this function assumes that the desired medium
+    which the model should be testedin, has already been assigned to the model
+    via the model.medium attribute.
+    FVA is run directly over the exchange reactions only, instead of via
+    model.summary which solves the variability of every reaction in the model.
+
+    Parameters
+    ----------
+    model : COBRA-model object
+
+    Returns
+    -------
+    solution : pandas DataFrame
+        A dataframe representing the secretion profile of a model
+
+    '''
+    print(model)
+    # assuming desired medium has already been assigned to model as medium
+    # processes=1 keeps the FVA single-process; parallelism happens across
+    # models in the worker pool, not within each FVA
+    fva = flux_variability_analysis(model, reaction_list=model.exchanges,
+                                    fraction_of_optimum=0.9, processes=1)
+    # exchange fluxes are positive for secretion; only exchanges whose FVA
+    # maximum clears the solver tolerance are kept, dropping solver noise
+    # and forced-uptake exchanges as model.summary does. The sign is
+    # flipped so the profile keeps the metabolite-centric convention of
+    # the summary, in which secreted compounds carry negative values
+    secreting = fva['maximum'] > model.tolerance
+    solution = -fva.loc[secreting, ['maximum']]
+    solution.columns = ['minimum']
+    return solution
+
+
+def create_secretions_df(secretion_profiles):
+    '''
+    A function for gathering the secretion profiles of all models
+    who grew in a specific growth iteration
+
+    Parameters
+    ----------
+    secretion_profiles : dict
+        A dictionary mapping the ids of models who grew in that specific
+        iteration to their secretion profile dataframes
+
+    Returns
+    -------
+    secretion_df : pandas DataFrame
+        a matrix represnting the secretion profiles of all models
+        who grew in that specific iteration.
+
+    '''
+    mod_df_dict = {k: v for k, v in secretion_profiles.items() if v.empty != True}
+    secretion_df = pd.concat(list(mod_df_dict.values()), axis=1, copy=False)
+    secretion_df.columns = list(mod_df_dict.keys())
+    return secretion_df
+
+
+# one single-process pool per worker, created once and reused by all
+# iterations; each chunk of models is always submitted to the same pool,
+# so a model lives (and keeps its LP basis) in exactly one worker process
+_executors = None
+
+
+def _get_executors():
+    global _executors
+    if _executors is None:
+        _executors = [ProcessPoolExecutor(max_workers=1)
+                      for _ in range(os.cpu_count())]
+    return _executors
+
+
+# cache of loaded models in the worker process; a model is read from disk
+# only once and between iterations only its exchange bounds change, letting
+# the solver warm start from the previous LP basis
+_worker_models = {}
+
+
+def _get_worker_model(model_path):
+    try:
+        return _worker_models[model_path]
+    except KeyError:
+        model = cobra.io.read_sbml_model(model_path)
+        try:
+            # keep the primal simplex so the basis is reused across the
+            # bound changes done by the medium assignments
+            model.solver.configuration.lp_method = 'primal'
+        except Exception:
+            pass # solver does not expose the lp method
+        _worker_models[model_path] = model
+        return model
+
+
+def _simulate_chunk(model_paths, medium):
+    '''
+    A worker function simulating the growth of a chunk of GSMMs in a given
+    medium. The models are read from disk inside the worker process and
+    kept alive there between iterations, so that only their paths and the
+    medium dict cross the process boundary and re-solves start from a warm
+    basis.
+
+    Parameters
+    ----------
+    model_paths : list
+        paths of the model xml files assigned to this worker.
+
+    medium : dict
+        A dict representing the medium used in that specific iteration.
+
+    Returns
+    -------
+    results : list
+        tuples of the model id, its growth value, and its secretion
+        profile dataframe (None if the model did not grow).
+
+    '''
+    results = []
+    for model_path in model_paths:
+        model = _get_worker_model(model_path)
+        medium_ = get_model_specific_medium(model, medium) # assign the correct medium as input
+        model.medium = medium_ # only updates exchange bounds, the LP is not rebuilt
+        growth = model.slim_optimize()
+        if growth > 0:
+            results.append((model.id, growth, get_secretion_profile(model)))
+        else:
+            results.append((model.id, growth, None))
+    return results
+
+
+def iterate_growth_and_secretion(model_paths, medium):
+    '''
+    An operative function using all the above functions to simulate the growth
+    of community GSMMs in a specific enviornment, as well as obtaining both
+    the secretion profile of the community, and consequently the medium for
+    the next iteration to be executed. The growth simulations of the models
+    are independent of each other, and are therefore dispatched in fixed
+    chunks to persistent worker processes (each worker keeps its own models
+    loaded across iterations).
+
+    Parameters
+    ----------
+    model_paths : list
+        array of paths of all GSMM xml files.
+
+    medium : dict
+        A dict representing the medium used in that specific iteration.
+
+    Returns
+    -------
+    A tuple holding:
+
+        1. next_round_medium
+        2. growths_dict
+        3. secretion_profiles:
+
+        next_round_medium : dict
+            a dictionary holding all compounds secreted by the bacteria grew in
+            the last round, added to the compounds already present from the last round
+
+        growths_dict : dict
+            dictionary holding models as keys and their growth as value for each round
+
+        secretion_profiles : dict
+            dictionary mapping the ids of the models who grew to their
+            secretion profile dataframes.
+
+    '''
+    growths_dict = {}
+    secretion_profiles = {}
+    secretion_union = set()
+    executors = _get_executors()
+    # round-robin chunks are deterministic, so each model is simulated by
+    # the same worker process in every iteration
+    chunks = [model_paths[i::len(executors)] for i in range(len(executors))]
+    futures = [executor.submit(_simulate_chunk, chunk, medium)
+               for executor, chunk in zip(executors, chunks) if chunk]
+    for future in as_completed(futures):
+        for model_id, growth, secretion_profile in future.result():
+            if growth > 0:
+                growths_dict[model_id] = growth
+                secretion_profiles[model_id] = secretion_profile
+                secretion_union.update(secretion_profile.index)
+
+    next_round_medium = {**medium, **{i: 1000 for i in secretion_union}}
+    return next_round_medium, growths_dict, secretion_profiles
+
+
+
+def write_csv(df, path):
+    '''
+    A function to write a dataframe as csv through pyarrow's csv writer,
+    which is considerably faster than DataFrame.to_csv on the wide
+    secretion matrices. The index is materialized as the leading column
+    before the conversion, as DataFrame.to_csv writes it (from_pandas with
+    preserve_index would append it as the last column instead, breaking
+    the readers of the NETWORK module).
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+
+    path : str
+        the path of the csv file to write
+
+    Returns
+    -------
+    None.
+
+    '''
+    df = df.rename_axis('').reset_index()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+
+
+def medium_dict_to_df(medium, target_path, medium_name: str):
+    '''
+    A function to save the medium dict after each iteration as a dataframe.
+
+    Parameters
+    ----------
+    medium : dict
+        a dictionary of the new medium composed of secretions at current
+        iteration and the former iteration's medium.
+
+    target_path : str
+        A path for the directory in which the medium is saved
+
+    medium_name : str
+        The name of the given medium
+
+    Returns
+    -------
+    None.
+
+    '''
+    df_ = pd.DataFrame(medium.items(), columns=['exchange', 'flux'])
+    write_csv(df_, target_path + 'media/' + medium_name + '.csv')
+
+def save_secretion_and_growths_dfs(growths, secretion_profiles, number: str):
+    '''
+    A function to save the secretions and growths dataframes.
+    The combined secretions matrix is only needed for the csv output, so it
+    is assembled here with a single concat rather than inside the iteration.
+
+    Parameters
+    ----------
+    growths : dict
+        A dictionary holding the growth values of all GSMMs who grew in
+        the current iteration.
+    secretion_profiles : dict
+        A dictionary mapping the ids of commnity members who grew at that
+        specific iteration to their secretion profile dataframes.
+    number : str
+        a string of a number representing the iteration in which the growth
+        and secretion data were gathered
+
+    Returns
+    -------
+    None.
+
+    '''
+    growth_df = pd.DataFrame(growths.items(), columns=['GSMM', 'growth'])
+    write_csv(growth_df, target_dir + 'growths/' + 'growths_' + number + '.csv')
+    secretions_df = create_secretions_df(secretion_profiles)
+    write_csv(secretions_df, target_dir + 'secretions/' + 'secretion_' + number + '.csv')
+
+
+
+# =============================================================================
+# =============================================================================
+# ITERATION RUNS ARE SEPARATED SINCE RUNTIME IS LONG AND DATA ACQUISITION IS 
+# NECESSARY 
+# =============================================================================
+# =============================================================================
+
+# =============================================================================
+# preliminary runs of the iterations.
+# =============================================================================
+
+if __name__ == '__main__':
+
+    model_paths = [models_dir + '/' + model_name for model_name in os.listdir(models_dir)]
+
+    medium_0 = pd.read_csv(media_dir + 'initial_root_environment_medium_for_iterations.csv', index_col=0)
+    medium_0 = dict(medium_0.values)
+
+    # =============================================================================
+    # iteration 1
+    # =============================================================================
+
+    medium_1, growths_1, secretions_1 = iterate_growth_and_secretion(model_paths, medium_0)
+
+    medium_dict_to_df(medium_1, target_dir, 'medium_1')
+    save_secretion_and_growths_dfs(growths_1, secretions_1, '1')
+
+    # =============================================================================
+    # iteration 2
+    # =============================================================================
+
+
+    medium_2, growths_2, secretions_2 = iterate_growth_and_secretion(model_paths, medium_1)
+
+    medium_dict_to_df(medium_2, target_dir, 'medium_2')
+    save_secretion_and_growths_dfs(growths_2, secretions_2, '2')
+
+    # =============================================================================
+    # iteration 3
+    # =============================================================================
+
+    medium_3, growths_3, secretions_3 = iterate_growth_and_secretion(model_paths, medium_2)
+
+    medium_dict_to_df(medium_3, target_dir, 'medium_3')
+    save_secretion_and_growths_dfs(growths_3, secretions_3, '3')
+
+    # =============================================================================
+    # iteration 4
+    # =============================================================================
+
+    P_compounds = pd.read_csv(media_dir + 'P_compounds_from_minimal_media.csv', index_col=0)
+    P_compounds = dict(P_compounds.values) # an addition of more compounds to medium
+
+    comb_medium = {**P_compounds, **medium_3}
+
+    medium_4, growths_4, secretions_4 = iterate_growth_and_secretion(model_paths, comb_medium)
+
+    medium_dict_to_df(medium_4, target_dir, 'medium_4')
+    save_secretion_and_growths_dfs(growths_4, secretions_4, '4')
+
+    # =============================================================================
+    # iteration 5
+    # =============================================================================
+
+    medium_5, growths_5, secretions_5 = iterate_growth_and_secretion(model_paths, medium_4)
+
+    medium_dict_to_df(medium_5, target_dir, 'medium_5')
+    save_secretion_and_growths_dfs(growths_5, secretions_5, '5')
@@ -29,11 +29,11 @@ of uptake and secretion of metabolites.
 # =============================================================================
 
 import pandas as pd
-import cobra 
+import numpy as np
+import pyarrow.csv as pacsv
+import cobra
 import os
-from collections import defaultdict
-from itertools import chain
-from operator import methodcaller
+from concurrent.futures import ProcessPoolExecutor
 
 
 # =============================================================================
@@ -53,94 +53,80 @@ target_path = base_dir + 'target/network/' # path for saving data
 # =============================================================================
 
 
-def read_all_secretions(secretions_dir):
-    df_list = []
-    for sec in os.listdir(secretions_dir):
-        if sec.startswith("."): continue
-        df = pd.read_csv(secretions_dir + sec)
-        df = df.set_index('Unnamed: 0', drop=True)
-        df_list.append(df)
-    return df_list
-
-
 def turn_secretion_df_to_dict(secretions_dir):
+    # each secretion matrix is streamed with pyarrow's multi-threaded csv
+    # reader and reduced to its negative (secreted) entries straight from
+    # the arrow columns, with no intermediate pandas dataframe
     dict_list = []
-    secretions_df_list = read_all_secretions(secretions_dir)
-    for df in secretions_df_list:
+    for sec in os.listdir(secretions_dir):
+        if sec.startswith("."): continue
+        table = pacsv.read_csv(secretions_dir + sec)
+        idx = table.column(0).to_numpy() # first column holds the exchange ids
         secretions_dict = {}
-        for col in df.columns:
-            s = df[col]
-            s = s[s.values < 0]
-            secretions_dict[col] = s.index.tolist()
+        for name in table.column_names[1:]:
+            flux = table.column(name).to_numpy()
+            secretions_dict[name] = idx[flux < 0].tolist()
         dict_list.append(secretions_dict)
     return dict_list
 
 
-def create_default_dict(secretions_dir):
-    dict_list = turn_secretion_df_to_dict(secretions_dir)
-    dd = defaultdict(list)
-    dict_items = map(methodcaller('items'), [(d) for d in dict_list])
-    for k, v in chain.from_iterable(dict_items):
-        dd[k].extend(v)
-    return dd
-
-
 def generate_final_secretions(secretions_dir):
-    dd = create_default_dict(secretions_dir)
-    res = {}
-    for k, v in dd.items():
-        v_mod = list(set(v))
-        res[k] = v_mod
-    return res
+    # the per-iteration dicts are merged and deduplicated in one streaming
+    # pass; dict.fromkeys keeps the first-seen order of the secretions
+    dict_list = turn_secretion_df_to_dict(secretions_dir)
+    dd = {}
+    for d in dict_list:
+        for k, v in d.items():
+            dd.setdefault(k, {}).update(dict.fromkeys(v))
+    return {k: list(seen) for k, seen in dd.items()}
 
 
-def get_filtered_secretions(secretions_dir):
+def get_filtered_secretions(final_secretions):
     organic_compounds_df = pd.read_csv(base_dir + 'organic_metabolites_formulas.csv', index_col=0)
-    final_secretions = generate_final_secretions(secretions_dir)
-    organic_dict = dict(organic_compounds_df.values)
-    filtered_secretions= {}
+    organic_set = set(organic_compounds_df['metabolite'])
+    filtered_secretions = {}
     for k, v in final_secretions.items():
-        l = []
-        for i in v:
-            if i in organic_dict.keys():
-                l.append(i)
-                filtered_secretions[k] = l
+        l = [i for i in v if i in organic_set]
+        if l: # GSMMs with no organic secretions are left out, as before
+            filtered_secretions[k] = l
     return filtered_secretions
                 
 
-def create_models(models_dir: str, sceretions_dir):
-    secretions = generate_final_secretions(secretions_dir)
-    secreting_gsmms = sorted([i for i in list(secretions.keys())])
+def _read_model(model_path):
+    # worker for the model-loading pool; models that fail to parse are
+    # reported as None and skipped by the caller
+    try:
+        return cobra.io.read_sbml_model(model_path)
+    except:
+        return None
+
+
+def create_models(models_dir: str, final_secretions):
+    secreting_gsmms = sorted(final_secretions.keys())
+    model_paths = [models_dir + model_name + '.xml' for model_name in secreting_gsmms]
     models = []
-    for model_name in secreting_gsmms:
-        print(model_name)
-        try:
-            model = cobra.io.read_sbml_model(models_dir + model_name + '.xml')
-        except:
-            continue
-        models.append(model)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for model_name, model in zip(secreting_gsmms, executor.map(_read_model, model_paths)):
+            print(model_name)
+            if model is None:
+                continue
+            models.append(model)
     return models
 
 
-def get_exchanges(model):
-    sep = ' '
-    model_data = []
-    data = model.exchanges
-    for datum in data:
-        datum = str(datum)
-        datum = datum.split(sep,1)[0]
-        datum = datum.replace(':', '')
-        model_data.append(datum)
-    return model_data
+def get_exchange_ids(model):
+    # the exchanges of a model never change, so the id set is computed once
+    # per model and cached on the model object itself
+    try:
+        return model._exchange_ids
+    except AttributeError:
+        model._exchange_ids = frozenset(rxn.id for rxn in model.exchanges)
+        return model._exchange_ids
 
 
 def get_model_specific_medium_mod(model, medium_dict):
-    exchanges = get_exchanges(model)
-    temp_li = []
-    for k, v in medium_dict.items():
-        if k in exchanges:
-            temp_li.append(k)
-    return temp_li
+    exchange_ids = get_exchange_ids(model)
+    return [k for k in medium_dict if k in exchange_ids]
 
 
 def get_final_medium(medium_dir, final_medium_file):
@@ -149,8 +135,8 @@ def get_final_medium(medium_dir, final_medium_file):
     return medium
 
 
-def get_models_uptakes(secretions_dir, models_dir, medium_dir, final_medium_file):
-    models = create_models(models_dir, secretions_dir)
+def get_models_uptakes(final_secretions, models_dir, medium_dir, final_medium_file):
+    models = create_models(models_dir, final_secretions)
     uptake_dict = {}
     medium = get_final_medium(medium_dir, final_medium_file)
     for model in models:
@@ -159,35 +145,42 @@ def get_models_uptakes(secretions_dir, models_dir, medium_dir, final_medium_file
     return uptake_dict
 
 
-def set_uptake_tuples(secretions_dir, models_dir, medium_dir, final_medium_file):
-    uptake_dict = get_models_uptakes(secretions_dir, models_dir, medium_dir, final_medium_file)
-    models_uptakes = []
+def set_uptake_tuples(final_secretions, models_dir, medium_dir, final_medium_file):
+    # the uptake edges are built as numpy column arrays (metabolite -> GSMM)
+    # rather than one python tuple per edge
+    uptake_dict = get_models_uptakes(final_secretions, models_dir, medium_dir, final_medium_file)
+    from_cols = []
+    to_cols = []
     for k, v in uptake_dict.items():
-        for exc in v:
-            tup = (exc, k)
-            models_uptakes.append(tup)
-    return models_uptakes
-        
-
-def set_secretion_tuples(secretions_dir):
-    final_secretions = get_filtered_secretions(secretions_dir)
-    models_secretion = []
-    for k, v in final_secretions.items():
-        for exc in v:
-            tup = (k, exc)
-            models_secretion.append(tup)
-    return models_secretion
+        from_cols.append(np.asarray(v, dtype=object))
+        to_cols.append(np.repeat(k, len(v)))
+    return from_cols, to_cols
+
+
+def set_secretion_tuples(final_secretions):
+    # the secretion edges are built as numpy column arrays (GSMM -> metabolite)
+    # rather than one python tuple per edge
+    filtered_secretions = get_filtered_secretions(final_secretions)
+    from_cols = []
+    to_cols = []
+    for k, v in filtered_secretions.items():
+        from_cols.append(np.repeat(k, len(v)))
+        to_cols.append(np.asarray(v, dtype=object))
+    return from_cols, to_cols
 
 
 def main(secretions_dir, models_dir, medium_dir, final_medium_file, target_path=None):
-    models_uptakes = set_uptake_tuples(secretions_dir, models_dir, medium_dir, final_medium_file)
-    models_secretions = set_secretion_tuples(secretions_dir)
-    data = models_uptakes + models_secretions
-    return data
+    # the merged secretions dict is computed once and threaded through,
+    # instead of each step re-reading every secretion csv on its own
+    final_secretions = generate_final_secretions(secretions_dir)
+    uptake_from, uptake_to = set_uptake_tuples(final_secretions, models_dir, medium_dir, final_medium_file)
+    secretion_from, secretion_to = set_secretion_tuples(final_secretions)
+    df = pd.DataFrame({'from': np.concatenate(uptake_from + secretion_from),
+                       'to': np.concatenate(uptake_to + secretion_to)})
+    return df
 
 
 if __name__ == '__main__':
-    tup_li = main(secretions_dir, models_dir, medium_dir, final_medium_file, target_path=None)
-    df = pd.DataFrame(tup_li, columns=['from', 'to'])
+    df = main(secretions_dir, models_dir, medium_dir, final_medium_file, target_path=None)
     df.to_csv(target_path + 'network_tuples_df.csv')
 
@@ -24,6 +24,15 @@ import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 import os
+import pickle
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the traversal functions below run as
+    # plain python over the same numpy arrays
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # =============================================================================
 # parameters for the functions: to be filled by user.
@@ -37,6 +46,7 @@ ex_filename = 'exudates.csv'  # name of the exudates csv file - a pandas datafra
 edge_course_list = ['BjSA', 'NTC', 'NA']  # a list holding names (strings) of differential abundance classifications.
 da_file_name = 'DA_classification.csv' # a string of the name of the dataframe holding classification of GSMMs to different treatments
 target_dir = base_dir + 'target/paths/' # a directory to hold all files generated throughout the analyses
+cache_dir = target_dir + '.cache/' # pickled artifacts reused across runs, keyed by source file mtime
 
 
 # =============================================================================
@@ -79,6 +89,49 @@ def build_G(net_filename, network_dir):
     return G
 
 
+def load_or_build(cache_name, source_path, build):
+    '''
+    Caches the result of an expensive build step as a pickle stamped with
+    the source file's modification time; repeat runs with an unchanged
+    source load the pickle instead of re-parsing the csv.
+
+    Parameters
+    ----------
+    cache_name : str
+        name of the pickle file in the cache directory.
+    source_path : str
+        path of the csv file the artifact is built from.
+    build : callable
+        a no-argument callable building the artifact from scratch.
+
+    Returns
+    -------
+    The cached or freshly built artifact.
+
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = cache_dir + cache_name + '.pkl'
+    mtime = os.path.getmtime(source_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached_mtime, obj = pickle.load(f)
+        if cached_mtime == mtime:
+            return obj
+    obj = build()
+    with open(cache_path, 'wb') as f:
+        pickle.dump((mtime, obj), f)
+    return obj
+
+
+def build_DA_map(base_dir, da_file_name):
+    '''
+  GSMM -> DA classification lookup, with missing scores filled as 'NA'.
+
+    '''
+    DA = get_DA(base_dir, da_file_name)
+    return dict(zip(DA['GSMM'], DA['DA_final_score'].fillna('NA')))
+
+
 def create_parquet_dir(base_dir):
     '''
     creates a directory to hold all parquest tables 
@@ -99,9 +152,178 @@ def create_parquet_dir(base_dir):
     return path + '/'
     
 
+def build_csr_adjacency(G):
+    '''
+    Converts the networkx graph to a CSR adjacency once, after build_G.
+    The graph is static from that point on, and the BFS then runs over two
+    flat integer arrays instead of the nested node dicts of networkx.
+
+    Parameters
+    ----------
+    G : networkx directed graph object
+
+    Returns
+    -------
+    node_list : list
+        node names, by integer node id.
+    node_index : dict
+        mapping of node name to integer node id.
+    indptr, indices : numpy arrays
+        the CSR representation of the adjacency.
+
+    '''
+    node_list = list(G.nodes())
+    node_index = {n: i for i, n in enumerate(node_list)}
+    adj = nx.to_scipy_sparse_array(G, nodelist=node_list, format='csr')
+    return node_list, node_index, adj.indptr, adj.indices
+
+
+@njit(cache=True)
+def bfs_pred_csr(indptr, indices, start, max_depth):
+    '''
+    A depth-capped BFS over the CSR adjacency, recording every shortest-path
+    predecessor of each reached node (scipy's breadth_first_order keeps a
+    single predecessor per node, which would drop alternative shortest
+    paths). The predecessors are returned in CSR form as well, so the whole
+    traversal is pure integer array manipulation and can be jitted.
+
+    Parameters
+    ----------
+    indptr, indices : numpy arrays
+        the CSR representation of the adjacency.
+    start : int
+        integer id of the BFS source node.
+    max_depth : int
+        number of BFS levels to expand.
+
+    Returns
+    -------
+    dist : numpy array
+        BFS distance of every node from start (-1 if not reached).
+    pindptr, pindices : numpy arrays
+        the shortest-path predecessors of every node, in CSR form.
+
+    '''
+    n = indptr.shape[0] - 1
+    dist = np.full(n, -1, np.int32)
+    dist[start] = 0
+    frontier = np.empty(n, np.int32)
+    frontier[0] = start
+    f_len = 1
+    cap = 1024
+    pe_v = np.empty(cap, np.int32) # predecessor edges, as (node, pred) pairs
+    pe_u = np.empty(cap, np.int32)
+    m = 0
+    for depth in range(1, max_depth + 1):
+        next_frontier = np.empty(n, np.int32)
+        next_len = 0
+        for fi in range(f_len):
+            u = frontier[fi]
+            for j in range(indptr[u], indptr[u + 1]):
+                v = indices[j]
+                if dist[v] == -1:
+                    dist[v] = depth
+                    next_frontier[next_len] = v
+                    next_len += 1
+                if dist[v] == depth:
+                    if m == cap:
+                        cap *= 2
+                        new_v = np.empty(cap, np.int32)
+                        new_v[:m] = pe_v[:m]
+                        pe_v = new_v
+                        new_u = np.empty(cap, np.int32)
+                        new_u[:m] = pe_u[:m]
+                        pe_u = new_u
+                    pe_v[m] = v
+                    pe_u[m] = u
+                    m += 1
+        frontier = next_frontier
+        f_len = next_len
+        if f_len == 0:
+            break
+    # bucket the predecessor edges by node into CSR form
+    counts = np.zeros(n + 1, np.int64)
+    for i in range(m):
+        counts[pe_v[i] + 1] += 1
+    pindptr = np.cumsum(counts)
+    fill = pindptr[:-1].copy()
+    pindices = np.empty(m, np.int32)
+    for i in range(m):
+        v = pe_v[i]
+        pindices[fill[v]] = pe_u[i]
+        fill[v] += 1
+    return dist, pindptr, pindices
+
+
+@njit(cache=True)
+def enumerate_paths(pindptr, pindices, ends, path_len):
+    '''
+    Enumerates all shortest paths leading to the given end nodes, by walking
+    the CSR predecessor arrays backwards with an iterative DFS. Every
+    predecessor of a node sits one BFS level closer to the source, so each
+    walk of path_len nodes necessarily ends at the source.
+
+    Parameters
+    ----------
+    pindptr, pindices : numpy arrays
+        the shortest-path predecessors of every node, in CSR form.
+    ends : numpy array
+        integer ids of the nodes the paths should lead to.
+    path_len : int
+        number of nodes in each path.
+
+    Returns
+    -------
+    out : numpy array
+        the enumerated paths, flattened; path_len entries per path.
+
+    '''
+    cap = 1024
+    out = np.empty(cap * path_len, np.int32)
+    n_paths = 0
+    path = np.empty(path_len, np.int32)
+    cursor = np.empty(path_len, np.int64)
+    for e in range(ends.shape[0]):
+        path[path_len - 1] = ends[e]
+        k = path_len - 1
+        cursor[k] = pindptr[path[k]]
+        while True:
+            if k == 0: # a complete path; emit it and backtrack
+                if n_paths == cap:
+                    cap *= 2
+                    new_out = np.empty(cap * path_len, np.int32)
+                    new_out[:n_paths * path_len] = out[:n_paths * path_len]
+                    out = new_out
+                base = n_paths * path_len
+                for t in range(path_len):
+                    out[base + t] = path[t]
+                n_paths += 1
+                k = 1
+                continue
+            if cursor[k] < pindptr[path[k] + 1]:
+                path[k - 1] = pindices[cursor[k]]
+                cursor[k] += 1
+                k -= 1
+                if k > 0:
+                    cursor[k] = pindptr[path[k]]
+            else:
+                if k == path_len - 1:
+                    break
+                k += 1
+    return out[:n_paths * path_len]
+
+
 def make_parquet_tables(G, EXUDATES, praquet_dir_path):
     """
-      Generates a table of exchange paths for each exudate, and saves it in a parquet table in the designated directory.
+      Generates tables of exchange paths for each exudate, and saves them in parquet tables in the designated directory.
+      The graph is converted once to a CSR adjacency, and a single BFS per
+      exudate records the shortest-path predecessors of every reachable
+      node; paths are then reconstructed from that mapping instead of
+      re-running a shortest path search per end node.
+      Only paths of lengths 3 (PM) and 5 (PMM) are biologically relevant
+      downstream, so the BFS is capped at depth 4 (5 nodes) and the two
+      lengths are written to separate parquet files per exudate, sparing
+      the storage and re-filtering of longer paths.
 
       Parameters
       ----------
@@ -114,21 +336,30 @@ def make_parquet_tables(G, EXUDATES, praquet_dir_path):
 
   """
 
-    min_len = 3
-    nodes = list(G.nodes())
+    pm_len = 3
+    pmm_len = 5
+    node_list, node_index, indptr, indices = build_csr_adjacency(G)
     for start in EXUDATES:
-        dic = {start: []}
-        for end in nodes:
-            try:
-                for path in nx.all_shortest_paths(G, start, end, weight=None, method='dijkstra'):
-                    if len(path) >= min_len:
-                        dic[start].append(path)
-                        if len(path) < min_len:
-                            print()
-            except:
-                continue
-        table = pa.table(dic)
-        pq.write_table(table, praquet_dir_path + '/' + start + '.parquet', use_dictionary=True)
+        pm_paths = []
+        pmm_paths = []
+        if start in node_index:
+            dist, pindptr, pindices = bfs_pred_csr(indptr, indices,
+                                                   node_index[start],
+                                                   pmm_len - 1)
+            # nodes at BFS depth 2 yield the length-3 paths, nodes at
+            # depth 4 the length-5 ones
+            pm_ends = np.flatnonzero(dist == pm_len - 1).astype(np.int32)
+            for row in enumerate_paths(pindptr, pindices, pm_ends,
+                                       pm_len).reshape(-1, pm_len):
+                pm_paths.append([node_list[i] for i in row])
+            pmm_ends = np.flatnonzero(dist == pmm_len - 1).astype(np.int32)
+            for row in enumerate_paths(pindptr, pindices, pmm_ends,
+                                       pmm_len).reshape(-1, pmm_len):
+                pmm_paths.append([node_list[i] for i in row])
+        pq.write_table(pa.table({start: pm_paths}),
+                       praquet_dir_path + '/PM_' + start + '.parquet', use_dictionary=True)
+        pq.write_table(pa.table({start: pmm_paths}),
+                       praquet_dir_path + '/PMM_' + start + '.parquet', use_dictionary=True)
     
 
 # =============================================================================
@@ -136,9 +367,13 @@ def make_parquet_tables(G, EXUDATES, praquet_dir_path):
 # =============================================================================
 
 parquet_dir_path = create_parquet_dir(base_dir)
-DA = get_DA(base_dir, da_file_name)
+# the classification map and the graph are pickled between runs, so repeat
+# runs over unchanged csv files skip the parse and rebuild entirely
+DA_MAP = load_or_build('DA_MAP', base_dir + da_file_name,
+                       lambda: build_DA_map(base_dir, da_file_name))
 EXUDATES = get_exudates(exudates_dir, ex_filename)
-G = build_G(net_filename, network_dir)
+G = load_or_build('G', network_dir + net_filename,
+                  lambda: build_G(net_filename, network_dir))
 
 # =============================================================================
 # Data generation functions
@@ -160,101 +395,82 @@ def get_classification(edge_course_list):
 
   '''
 
-    GSMM_list = []
-    for item in edge_course_list:
-        if item[0] == "G":
-            GSMM_list.append(DA['DA_final_score'][DA.index[DA['GSMM'] == item]].values[0])
-            res = ['NA' if pd.isnull(i) else i for i in GSMM_list]
-    return tuple(res)
+    return tuple(DA_MAP.get(item, 'NA') for item in edge_course_list if item[0] == "G")
 
 
-def build_PMM_edge_course_matrix(parquet_dir, target_dir, length=5):
+def read_paths(parquet_dir, prefix, exudate):
     '''
-
-  This function builds a CSV file for edge_courses, with emphasis on the
-  attrbiute in each position. length=5 for PMMs.
+  Reads the paths of a single exudate parquet table as a plain python list,
+  skipping the pandas DataFrame conversion.
 
   Parameters
   ----------
-  praquet_dir : str
-      directoriy location of all paquets tables.
-  length : int, optional
-      Length of edge course path. Default is 5.
+  parquet_dir : str
+      directory location of all parquet tables.
+  prefix : str
+      'PM_' or 'PMM_', selecting the path length of the table.
+  exudate : str
+      the exudate whose paths are read.
 
   Returns
   -------
-  pairs_dict: dict
-      a dictionary holds all PMM course-edge path with respect to position and attributes.
+  list
+      list of paths (each a list of node names).
 
   '''
-    pairs_dict = {'exudate': [],
-                  'GSMM1': [],
-                  'metabolite1': [],
-                  'GSMM2': [],
-                  'metabolite2': [],
-                  'classification': []}
+    table = pq.read_table(parquet_dir + prefix + exudate + '.parquet',
+                          columns=[exudate])
+    return table.column(0).to_pylist()
 
-    for exudate in EXUDATES:
-        table = pq.read_table(parquet_dir + exudate + '.parquet').to_pandas()
-        for edge in table[exudate]:
-            if len(edge) == length and len(edge) > 0:                
-                pairs_dict['exudate'].append(edge[0])
-                pairs_dict['GSMM1'].append(edge[1])
-                pairs_dict['metabolite1'].append(edge[2])
-                pairs_dict['GSMM2'].append(edge[3])
-                pairs_dict['metabolite2'].append(edge[4])
-                pairs_dict['classification'].append(get_classification(edge))
-
-    df = pd.DataFrame.from_dict(pairs_dict)
-    # df = df.fillna('NA')
-    df.to_csv(target_dir + 'PMM_edge_courses_df.csv')
-    return df
-
-
-def build_PM_edge_course_matrix(praquet_dir, target_dir, length=3):
-    """
 
-  This function builds a CSV file for edge_courses, with emphasis on the
-  attrbiute in each position. length=3 for PMs.
+def build_edge_course_matrices(parquet_dir, target_dir):
+    '''
 
+  This function builds the CSV files for both PM (length 3) and PMM
+  (length 5) edge_courses, with emphasis on the attrbiute in each position.
+  Both matrices are accumulated in a single pass over the exudates, so each
+  parquet table is opened exactly once.
 
   Parameters
   ----------
   parquet_dir : str
-      directory location.
-  length : int, optional
-      DESCRIPTION. The default is 3.
+      directoriy location of all parquet tables.
+  target_dir : str
+      directory in which the CSV files are saved.
 
   Returns
   -------
-  pairs_dict: dict
-      a dictionary holds all PM course-edge path with respect to position and attributes.
+  A tuple holding the PMM and PM edge-course dataframes.
 
-  """
-    pairs_dict = {'exudate': [],
-                  'GSMM1': [],
-                  'metabolite1': [],
-                  'classification': []}
+  '''
+    pmm_columns = ['exudate', 'GSMM1', 'metabolite1', 'GSMM2', 'metabolite2',
+                   'classification']
+    pm_columns = ['exudate', 'GSMM1', 'metabolite1', 'classification']
+
+    # one row tuple per path instead of parallel per-column appends; the
+    # dataframes are built in a single shot from the collected records
+    pmm_rows = []
+    pm_rows = []
 
     for exudate in EXUDATES:
+        for edge in read_paths(parquet_dir, 'PMM_', exudate):
+            pmm_rows.append((edge[0], edge[1], edge[2], edge[3], edge[4],
+                             get_classification(edge)))
 
-        table = pq.read_table(praquet_dir + exudate + '.parquet').to_pandas()
+        for edge in read_paths(parquet_dir, 'PM_', exudate):
+            pm_rows.append((edge[0], edge[1], edge[2], get_classification(edge)))
 
-        for edge in table[exudate]:
-            if len(edge) == length and len(edge) > 0:
-                pairs_dict['exudate'].append(edge[0])
-                pairs_dict['GSMM1'].append(edge[1])
-                pairs_dict['metabolite1'].append(edge[2])
-                pairs_dict['classification'].append(get_classification(edge))
+    df_PMM = pd.DataFrame.from_records(pmm_rows, columns=pmm_columns)
+    # df_PMM = df_PMM.fillna('NA')
+    df_PMM.to_csv(target_dir + 'PMM_edge_courses_df.csv')
 
-    df = pd.DataFrame.from_dict(pairs_dict)
-    df['classification'] = [x[0] for x in df['classification']]
-    df = df.fillna('NA')
-    df.to_csv(target_dir + 'PM_edge_courses_df.csv')
-    return df
+    df_PM = pd.DataFrame.from_records(pm_rows, columns=pm_columns)
+    df_PM['classification'] = [x[0] for x in df_PM['classification']]
+    df_PM = df_PM.fillna('NA')
+    df_PM.to_csv(target_dir + 'PM_edge_courses_df.csv')
+    return df_PMM, df_PM
 
 if __name__ == "__main__":
-    
+
     make_parquet_tables(G, EXUDATES, parquet_dir_path)
-    df_PMM = build_PMM_edge_course_matrix(parquet_dir_path, target_dir, length=5)
-    df_PM = build_PM_edge_course_matrix(parquet_dir_path, target_dir, length=3)
+    df_PMM, df_PM = build_edge_course_matrices(parquet_dir_path, target_dir)